@@ -1,9 +1,17 @@
+import heapq
 import logging
 import json
+import multiprocessing
+import operator
 import os
+from concurrent.futures import ProcessPoolExecutor
 from time import time
 from typing import Dict, List
 from tqdm import tqdm
+import datasets
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
 import torch
 import torch.nn.functional as F
 
@@ -14,10 +22,54 @@ from sentence_transformers.models import Transformer, WordEmbeddings
 
 from .AbsTask import AbsTask
 
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 logger = logging.getLogger(__name__)
 
 DRES_METHODS = ["encode_queries", "encode_corpus"]
 
+# Upper bound for the automatically chosen corpus_chunk_size
+MAX_CORPUS_CHUNK_SIZE = 500000
+
+# Each query must come with a one-sentence instruction that describes the task
+QUERY_TASK_DESCRIPTION = "Given a web search query, retrieve relevant passages that answer the query"
+
+# Llama instance owned by a pool worker process, see DRESModel._get_llama_pool
+_worker_llama_model = None
+
+
+def _dumps_json(obj):
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    # Equivalent JSON to orjson's, though float and NaN formatting may differ
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def _create_llama_embeddings(model, texts):
+    return [item["embedding"] for item in model.create_embedding(texts)["data"]]
+
+
+def _init_llama_worker(llama_state, cores_queue):
+    global _worker_llama_model
+    cores = cores_queue.get()
+    if cores and hasattr(os, "sched_setaffinity"):
+        # Keep llama.cpp threads of different workers on disjoint cores
+        os.sched_setaffinity(0, cores)
+        llama_state = {**llama_state, "n_threads": min(llama_state.get("n_threads") or len(cores), len(cores))}
+        if "n_threads_batch" in llama_state:
+            # Embedding calls run on the batch threads, which default to every core of the machine
+            llama_state["n_threads_batch"] = min(llama_state["n_threads_batch"] or len(cores), len(cores))
+    _worker_llama_model = Llama(**{**llama_state, "verbose": False})
+
+
+def _embed_llama_chunk(texts):
+    return _create_llama_embeddings(_worker_llama_model, texts)
+
+
 class AbsTaskRetrieval(AbsTask):
     """
     Abstract class for re-ranking experiments.
@@ -38,6 +90,24 @@ class AbsTaskRetrieval(AbsTask):
                 return False
         return True
 
+    @staticmethod
+    def _autotune_chunk(model, sample_doc, num_queries, corpus_size, batch_size):
+        """
+        Largest corpus chunk whose GPU buffers fit in 60% of the free GPU memory, kept between batch_size and
+        MAX_CORPUS_CHUNK_SIZE and no larger than the corpus. D is taken from encoding one document.
+        """
+        sample_embedding = model.encode_corpus([sample_doc], batch_size=1, convert_to_tensor=True)
+        if not getattr(sample_embedding, "is_cuda", False):
+            # Embeddings and scores are kept on the CPU
+            return 50000
+        dim, element_size = sample_embedding.shape[-1], sample_embedding.element_size()
+        # Per doc: the per-batch embeddings and their stacked copy while encoding, the normalized copy made by
+        # cos_sim, one score per query and one byte per query for the torch.isnan mask over the scores
+        bytes_per_doc = 3 * dim * element_size + num_queries * (element_size + 1)
+        free_mem, _ = torch.cuda.mem_get_info()
+        chunk_size = max(min(int(0.6 * free_mem / bytes_per_doc), MAX_CORPUS_CHUNK_SIZE), batch_size)
+        return min(chunk_size, corpus_size)
+
     def evaluate(
         self,
         model,
@@ -56,11 +126,29 @@ class AbsTaskRetrieval(AbsTask):
         if not self.data_loaded:
             self.load_data(parallel_retrieval=parallel_retrieval)
 
-        model = model if self.is_dres_compatible(model) else DRESModel(model)
+        # cos_sim normalizes the embeddings itself, so the wrapper does not need to
+        model = (
+            model
+            if self.is_dres_compatible(model)
+            else DRESModel(model, normalize_embeddings=score_function != "cos_sim")
+        )
+        dres_model = model
 
         if not parallel_retrieval:
             # Non-distributed
             from beir.retrieval.search.dense import DenseRetrievalExactSearch as DRES
+            if corpus_chunk_size is None and torch.cuda.is_available():
+                if self.is_multilingual:
+                    corpus = self.corpus[self.langs[0]][split]
+                    num_queries = max(len(self.queries[lang][split]) for lang in self.langs)
+                    corpus_size = max(len(self.corpus[lang][split]) for lang in self.langs)
+                else:
+                    corpus = self.corpus[split]
+                    num_queries, corpus_size = len(self.queries[split]), len(corpus)
+                corpus_chunk_size = self._autotune_chunk(
+                    model, next(iter(corpus.values())), num_queries, corpus_size, batch_size
+                )
+                logger.info(f"Using corpus_chunk_size: {corpus_chunk_size}")
             model = DRES(
                 model,
                 batch_size=batch_size,
@@ -85,19 +173,25 @@ class AbsTaskRetrieval(AbsTask):
         retriever = EvaluateRetrieval(model, score_function=score_function)  # or "cos_sim" or "dot"
 
         scores = {}
-        if self.is_multilingual:
-            for lang in self.langs:
-                logger.info(f"Language: {lang}")
-                corpus, queries, relevant_docs = self.corpus[lang][split], self.queries[lang][split], self.relevant_docs[lang][split]
-                scores[lang] = self._evaluate_monolingual(retriever, corpus, queries, relevant_docs, lang, **kwargs)
-        else:
-            corpus, queries, relevant_docs = self.corpus[split], self.queries[split], self.relevant_docs[split]
-            scores = self._evaluate_monolingual(retriever, corpus, queries, relevant_docs, None, **kwargs)
+        try:
+            if self.is_multilingual:
+                for lang in self.langs:
+                    logger.info(f"Language: {lang}")
+                    corpus, queries, relevant_docs = self.corpus[lang][split], self.queries[lang][split], self.relevant_docs[lang][split]
+                    scores[lang] = self._evaluate_monolingual(retriever, corpus, queries, relevant_docs, lang, **kwargs)
+            else:
+                corpus, queries, relevant_docs = self.corpus[split], self.queries[split], self.relevant_docs[split]
+                scores = self._evaluate_monolingual(retriever, corpus, queries, relevant_docs, None, **kwargs)
+        finally:
+            # Release llama.cpp worker processes and their model copies
+            if isinstance(dres_model, DRESModel):
+                dres_model.stop_llama_pool()
         return scores
 
     def _evaluate_monolingual(self, retriever, corpus, queries, relevant_docs, lang=None, **kwargs):
         start_time = time()
-        results = retriever.retrieve(corpus, queries)
+        with torch.no_grad():
+            results = retriever.retrieve(corpus, queries)
         end_time = time()
         logger.info("Time taken to retrieve: {:.2f} seconds".format(end_time - start_time))
 
@@ -105,18 +199,11 @@ class AbsTaskRetrieval(AbsTask):
             output_folder = kwargs.get("output_folder", "results")
             if not os.path.isdir(output_folder):
                 os.makedirs(output_folder)
-            top_k = kwargs.get('top_k', None)
-            if top_k is not None:
-                for qid in list(results.keys()):
-                    doc_ids = set(sorted(results[qid], key=lambda x: results[qid][x], reverse=True)[:top_k])
-                    results[qid] = {k: v for k, v in results[qid].items() if k in doc_ids}
             if lang is None:
                 qrels_save_path = f"{output_folder}/{self.description['name']}_qrels.json"
             else:
                 qrels_save_path = f"{output_folder}/{self.description['name']}_{lang}_qrels.json"
-            
-            with open(qrels_save_path, "w") as f:
-                json.dump(results, f)
+            self._save_qrels(results, qrels_save_path, top_k=kwargs.get("top_k", None))
 
         ndcg, _map, recall, precision = retriever.evaluate(relevant_docs, results, retriever.k_values, ignore_identical_ids=kwargs.get("ignore_identical_ids", True))
         mrr = retriever.evaluate_custom(relevant_docs, results, retriever.k_values, "mrr")
@@ -129,6 +216,20 @@ class AbsTaskRetrieval(AbsTask):
         }
         return scores
 
+    @staticmethod
+    def _save_qrels(results, qrels_save_path, top_k=None):
+        """Writes the results one query at a time, keeping only the top_k documents per query if given"""
+        with open(qrels_save_path, "wb") as f:
+            f.write(b"{")
+            for i, (qid, doc_scores) in enumerate(results.items()):
+                if top_k is not None:
+                    doc_scores = dict(heapq.nlargest(top_k, doc_scores.items(), key=lambda item: item[1]))
+                if i > 0:
+                    f.write(b",")
+                # Keys are written as strings, as json.dump does for non-str keys
+                f.write(_dumps_json(str(qid)) + b":" + _dumps_json(doc_scores))
+            f.write(b"}")
+
 
 class DRESModel:
     """
@@ -136,41 +237,151 @@ class DRESModel:
     This class converts a MTEB model (with just an .encode method) into BeIR DRES format.
     """
 
-    def __init__(self, model, sep=" ", **kwargs):
+    def __init__(
+        self,
+        model,
+        sep=" ",
+        task_description=QUERY_TASK_DESCRIPTION,
+        normalize_embeddings=True,
+        device=None,
+        dtype=None,
+        num_processes=None,
+        n_threads=None,
+        n_batch=None,
+        n_gpu_layers=None,
+        **kwargs,
+    ):
         self.model = model
         self.sep = sep
+        # The instruction is identical for every query, so it is built once and prepended as is
+        self.query_prefix = f"Instruct: {task_description}\nQuery: "
         self.use_sbert_model = isinstance(model, SentenceTransformer)
+        # L2-normalization of llama.cpp embeddings, only needed when scoring is not cos_sim
+        self.normalize_embeddings = normalize_embeddings
+        # Device and dtype of the llama.cpp embeddings, e.g. "cuda" and torch.float16 to keep the
+        # similarity search on the GPU; beir's score functions handle fp16 tensors through torch.mm
+        self.device = device
+        self.dtype = dtype
+        # Number of worker processes for llama.cpp models, each loading its own copy of the model.
+        # The pool is stopped by stop_llama_pool(), on leaving a `with DRESModel(...)` block or at the
+        # end of AbsTaskRetrieval.evaluate
+        self.num_processes = num_processes
+        self._pool = None
+        if isinstance(model, Llama):
+            # n_batch should cover the longest input so that llama.cpp prefills it in a single pass,
+            # i.e. n_batch = ceil(max_seq_len / 32) * 32 (capped by n_ctx)
+            llama_state = model.__getstate__()
+            llama_overrides = {}
+            if n_threads is not None:
+                # Embedding calls decode multi-token batches, which llama.cpp runs with n_threads_batch
+                llama_overrides["n_threads"] = n_threads
+                if "n_threads_batch" in llama_state:
+                    llama_overrides["n_threads_batch"] = n_threads
+            if n_batch is not None:
+                llama_overrides["n_batch"] = n_batch
+                if "n_ubatch" in llama_state:
+                    llama_overrides["n_ubatch"] = n_batch
+            if n_gpu_layers is not None:
+                llama_overrides["n_gpu_layers"] = n_gpu_layers
+            # Every setting the model was created with and only the requested ones changed,
+            # so that reloaded models and pool workers otherwise match the given model
+            self._llama_state = {**llama_state, "embedding": True, **llama_overrides}
+            if self._use_llama_pool():
+                # Only the workers hold the model, the caller may free its own copy
+                self.model = None
+            elif llama_overrides:
+                self.model = Llama(**self._llama_state)
+            logger.info(
+                f"llama.cpp n_batch: {self._llama_state['n_batch']}, n_threads: {self._llama_state['n_threads']}, "
+                f"n_threads_batch: {self._llama_state.get('n_threads_batch')}"
+            )
+        self._encode_fn = self._encode_llama if isinstance(model, Llama) else self._encode_generic
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop_llama_pool()
+
+    def _use_llama_pool(self):
+        return self.num_processes is not None and self.num_processes > 1
+
+    def _get_llama_pool(self):
+        if self._pool is None:
+            ctx = multiprocessing.get_context("spawn")
+            if hasattr(os, "sched_getaffinity"):
+                cores = sorted(os.sched_getaffinity(0))
+            else:
+                cores = list(range(os.cpu_count()))
+            cores_queue = ctx.Queue()
+            for i in range(self.num_processes):
+                cores_queue.put(
+                    cores[i * len(cores) // self.num_processes : (i + 1) * len(cores) // self.num_processes]
+                )
+            logger.info(f"Starting {self.num_processes} llama.cpp worker processes")
+            # Unlike multiprocessing.Pool, a worker failing to load the model or being killed (e.g. out of
+            # memory) raises BrokenProcessPool instead of leaving the encode call waiting forever
+            self._pool = ProcessPoolExecutor(
+                self.num_processes,
+                mp_context=ctx,
+                initializer=_init_llama_worker,
+                initargs=(self._llama_state, cores_queue),
+            )
+        return self._pool
 
-    def get_detailed_instruct(self, task_description: str, query: str) -> str:
-        return f'Instruct: {task_description}\nQuery: {query}'
+    def stop_llama_pool(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
 
     def llama_wrapper_queries(self, queries, batch_size, **kwargs):
-        # Each query must come with a one-sentence instruction that describes the task
-        task_description = 'Given a web search query, retrieve relevant passages that answer the query'
-        queries_with_task = [self.get_detailed_instruct(task_description, query) for query in queries]
+        queries_with_task = [self.query_prefix + query for query in queries]
         return self.llama_wrapper(queries_with_task, batch_size, **kwargs)
 
     def llama_wrapper_corpus(self, queries, batch_size, **kwargs):
         return self.llama_wrapper(queries, batch_size, **kwargs)
 
     def llama_wrapper(self, queries, batch_size, **kwargs):
-      if isinstance(self.model, Llama):
-        all_embeddings = []
-        for query in tqdm(queries):
-          if len(query) > 10000:
-            print(f"Warning: Long query: ({len(query)}")
-          embeddings = self.model.create_embedding(query)["data"][0]["embedding"]
-          embeddings_normalized = list(F.normalize(torch.FloatTensor(embeddings), p=2, dim=-1))
-          all_embeddings.append(embeddings_normalized)
-        encoded_value = torch.FloatTensor(all_embeddings)
-      else:
-        encoded_value = self.model.encode(queries, batch_size=batch_size, **kwargs)
-
-    #   logger.info(f"Result type: {type(encoded_value)}")
-    #   logger.info(f"Rexult shape: {encoded_value.shape}")
-
-      return encoded_value
+        return self._encode_fn(queries, batch_size, **kwargs)
 
+    def _encode_llama(self, queries, batch_size, **kwargs):
+        # llama.cpp embeds a list of inputs in a single call, one "data" entry per input
+        chunks = []
+        for start_idx in range(0, len(queries), batch_size):
+            chunk = queries[start_idx : start_idx + batch_size]
+            longest = max(map(len, chunk))
+            if longest > 10000:
+                logger.warning(f"Long input of {longest} characters in batch starting at {start_idx}")
+            chunks.append(chunk)
+        if self._use_llama_pool():
+            chunk_embeddings = self._get_llama_pool().map(_embed_llama_chunk, chunks)
+        else:
+            chunk_embeddings = (_create_llama_embeddings(self.model, chunk) for chunk in chunks)
+        # The output is allocated once the embedding dimension is known from the first chunk
+        all_embeddings = np.empty((0, 0), dtype=np.float32)
+        start_idx = 0
+        # Progress is counted in texts but only refreshed once per chunk and at most once a second
+        pbar = tqdm(total=len(queries), mininterval=1.0, disable=not kwargs.get("show_progress_bar", True))
+        for embeddings in chunk_embeddings:
+            if start_idx == 0:
+                all_embeddings = np.empty((len(queries), len(embeddings[0])), dtype=np.float32)
+            all_embeddings[start_idx : start_idx + len(embeddings)] = embeddings
+            start_idx += len(embeddings)
+            pbar.update(len(embeddings))
+        pbar.close()
+        encoded_value = torch.from_numpy(all_embeddings)
+        if self.device is not None:
+            encoded_value = encoded_value.to(self.device, non_blocking=True)
+        if self.normalize_embeddings:
+            F.normalize(encoded_value, p=2, dim=1, out=encoded_value)
+        if self.dtype is not None:
+            encoded_value = encoded_value.to(self.dtype)
+        return encoded_value
+
+    def _encode_generic(self, queries, batch_size, **kwargs):
+        return self.model.encode(queries, batch_size=batch_size, **kwargs)
+
+    @torch.inference_mode()
     def encode_queries(self, queries: List[str], batch_size: int, **kwargs):
         if self.use_sbert_model:
             if isinstance(self.model._first_module(), Transformer):
@@ -182,19 +393,47 @@ class DRESModel:
         encoded_value = self.llama_wrapper_queries(queries, batch_size=batch_size, **kwargs)
         return encoded_value
 
+    @torch.inference_mode()
     def encode_corpus(self, corpus: List[Dict[str, str]], batch_size: int, **kwargs):
-        if type(corpus) is dict:
-            sentences = [
-                (corpus["title"][i] + self.sep + corpus["text"][i]).strip()
-                if "title" in corpus
-                else corpus["text"][i].strip()
-                for i in range(len(corpus["text"]))
-            ]
+        if isinstance(corpus, datasets.Dataset):
+            corpus = corpus.with_format("arrow")[:]
+        elif type(corpus) is dict and isinstance(corpus["text"], (pa.Array, pa.ChunkedArray)):
+            corpus = pa.table(corpus)
+
+        if isinstance(corpus, pa.Table):
+            # Arrow columns are joined and stripped with vectorized compute kernels
+            texts = corpus["text"]
+            if "title" in corpus.column_names:
+                texts = pc.binary_join_element_wise(corpus["title"], texts, self.sep)
+            sentences = pc.utf8_trim_whitespace(texts).to_pylist()
+        elif type(corpus) is dict:
+            if "title" in corpus:
+                sentences = list(
+                    map(operator.methodcaller("strip"), map(self.sep.join, zip(corpus["title"], corpus["text"])))
+                )
+            else:
+                sentences = [text.strip() for text in corpus["text"]]
         else:
             sentences = [
-                (doc["title"] + self.sep + doc["text"]).strip() if "title" in doc else doc["text"].strip()
+                self.sep.join((doc["title"], doc["text"])).strip() if "title" in doc else doc["text"].strip()
                 for doc in corpus
             ]
 
+        # Row of the encoded output for each sentence, None when no deduplication took place
+        sentence_rows = None
+        # Strided, since beir passes the corpus sorted by length and short duplicates end up at the tail
+        sample = sentences[:: max(1, len(sentences) // 10000)]
+        if sample and len(set(sample)) <= 0.98 * len(sample):
+            # Duplicated sentences are encoded once and gathered back afterwards
+            unique_rows = {}
+            sentence_rows = [unique_rows.setdefault(sentence, len(unique_rows)) for sentence in sentences]
+            sentences = list(unique_rows)
+
         encoded_value = self.llama_wrapper_corpus(sentences, batch_size=batch_size, **kwargs)
+        if sentence_rows is not None:
+            if isinstance(encoded_value, list):
+                # .encode(convert_to_numpy=False) returns a list of per-sentence tensors
+                encoded_value = [encoded_value[row] for row in sentence_rows]
+            else:
+                encoded_value = encoded_value[sentence_rows]
         return encoded_value
@@ -0,0 +1,108 @@
+import copy
+import importlib
+import json
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from mteb.abstasks.AbsTaskRetrieval import MAX_CORPUS_CHUNK_SIZE, AbsTaskRetrieval
+
+
+# The package re-exports the AbsTaskRetrieval class under the module's name
+retrieval_module = importlib.import_module("mteb.abstasks.AbsTaskRetrieval")
+
+
+class FakeCorpusEncoder:
+    """Returns a fixed embedding for any corpus, shaped like a (1, D) CUDA tensor if on_gpu"""
+
+    def __init__(self, dim, element_size, on_gpu=True):
+        self.embedding = SimpleNamespace(shape=(1, dim), is_cuda=on_gpu, element_size=lambda: element_size)
+
+    def encode_corpus(self, corpus, batch_size, **kwargs):
+        return self.embedding
+
+
+class TestAutotuneChunk:
+    def setup_method(self):
+        self.sample_doc = {"title": "", "text": "document"}
+
+    def test_chunk_fits_embeddings_and_scores(self, monkeypatch):
+        free_mem = 2**30
+        monkeypatch.setattr(torch.cuda, "mem_get_info", lambda: (free_mem, 2 * free_mem))
+
+        chunk = AbsTaskRetrieval._autotune_chunk(FakeCorpusEncoder(1024, 4), self.sample_doc, 1000, 10**7, 128)
+
+        assert chunk == int(0.6 * free_mem / (3 * 1024 * 4 + 1000 * 5))
+
+    def test_chunk_not_below_batch_size(self, monkeypatch):
+        monkeypatch.setattr(torch.cuda, "mem_get_info", lambda: (2**20, 2**30))
+
+        chunk = AbsTaskRetrieval._autotune_chunk(FakeCorpusEncoder(4096, 2), self.sample_doc, 100000, 10**7, 128)
+
+        assert chunk == 128
+
+    def test_chunk_capped(self, monkeypatch):
+        monkeypatch.setattr(torch.cuda, "mem_get_info", lambda: (2**40, 2**40))
+        encoder = FakeCorpusEncoder(384, 4)
+
+        assert AbsTaskRetrieval._autotune_chunk(encoder, self.sample_doc, 10, 10**7, 128) == MAX_CORPUS_CHUNK_SIZE
+        assert AbsTaskRetrieval._autotune_chunk(encoder, self.sample_doc, 10, 1000, 128) == 1000
+
+    def test_cpu_embeddings_keep_default(self):
+        encoder = FakeCorpusEncoder(1024, 4, on_gpu=False)
+
+        assert AbsTaskRetrieval._autotune_chunk(encoder, self.sample_doc, 1000, 10**7, 128) == 50000
+
+
+class TestSaveQrels:
+    def setup_method(self):
+        self.results = {
+            "q1": {"d1": 0.1, "d2": 0.9, "d3": 0.5},
+            "q\u00e9": {"d\u00e9": 0.25, "d2": 0.75},
+        }
+
+    def load(self, path):
+        with open(path) as f:
+            return json.load(f)
+
+    @pytest.mark.parametrize("results", [{}, {"q1": {"d1": 0.5}}, {"q1": {}}])
+    def test_round_trip_small(self, tmp_path, results):
+        path = tmp_path / "qrels.json"
+
+        AbsTaskRetrieval._save_qrels(results, path)
+
+        assert self.load(path) == results
+
+    def test_round_trip(self, tmp_path):
+        path = tmp_path / "qrels.json"
+
+        AbsTaskRetrieval._save_qrels(self.results, path)
+
+        assert self.load(path) == self.results
+
+    def test_non_str_keys(self, tmp_path):
+        path = tmp_path / "qrels.json"
+
+        AbsTaskRetrieval._save_qrels({1: {2: 0.5}}, path)
+
+        assert self.load(path) == {"1": {"2": 0.5}}
+
+    def test_top_k(self, tmp_path):
+        path = tmp_path / "qrels.json"
+        results = copy.deepcopy(self.results)
+
+        AbsTaskRetrieval._save_qrels(results, path, top_k=2)
+
+        assert self.load(path) == {"q1": {"d2": 0.9, "d3": 0.5}, "q\u00e9": {"d\u00e9": 0.25, "d2": 0.75}}
+        assert results == self.results
+
+    def test_orjson_and_json_match(self, tmp_path, monkeypatch):
+        pytest.importorskip("orjson")
+        orjson_path, json_path = tmp_path / "orjson.json", tmp_path / "json.json"
+
+        AbsTaskRetrieval._save_qrels(self.results, orjson_path, top_k=2)
+        monkeypatch.setattr(retrieval_module, "orjson", None)
+        AbsTaskRetrieval._save_qrels(self.results, json_path, top_k=2)
+
+        assert self.load(orjson_path) == self.load(json_path)
@@ -0,0 +1,212 @@
+import importlib
+import queue
+from concurrent.futures import BrokenExecutor, ThreadPoolExecutor
+from types import SimpleNamespace
+
+import datasets
+import numpy as np
+import pytest
+import torch
+from sentence_transformers import SentenceTransformer
+
+from mteb.abstasks.AbsTaskRetrieval import DRESModel
+
+
+# The package re-exports the AbsTaskRetrieval class under the module's name
+retrieval_module = importlib.import_module("mteb.abstasks.AbsTaskRetrieval")
+
+TOL = 0.0001
+DIM = 4
+
+
+class FakeLlama:
+    """Stands in for llama_cpp.Llama, returning a fixed embedding per input text"""
+
+    def __init__(self, **kwargs):
+        self.init_kwargs = kwargs
+        self.num_embedded = 0
+
+    def __getstate__(self):
+        return {
+            "model_path": "model.gguf",
+            "n_ctx": 512,
+            "n_batch": 512,
+            "n_threads": 1,
+            "n_threads_batch": 16,
+            **self.init_kwargs,
+        }
+
+    def create_embedding(self, texts):
+        self.num_embedded += len(texts)
+        return {"data": [{"index": i, "embedding": [float(len(text))] * DIM} for i, text in enumerate(texts)]}
+
+
+class FakeEncoder:
+    """Model with just an .encode method, as SentenceTransformer provides"""
+
+    def __init__(self):
+        self.encoded_sentences = []
+
+    def encode(self, sentences, batch_size=32, **kwargs):
+        self.encoded_sentences.extend(sentences)
+        if not kwargs.get("convert_to_numpy", True):
+            return [torch.full((DIM,), float(len(sentence))) for sentence in sentences]
+        return np.array([[float(len(sentence))] * DIM for sentence in sentences])
+
+
+class FakeSentenceTransformer(FakeEncoder):
+    """Passes the SentenceTransformer isinstance check without loading a model"""
+
+    __class__ = SentenceTransformer
+
+
+class FailingLlama(FakeLlama):
+    def __init__(self, **kwargs):
+        raise RuntimeError("failed to load model")
+
+
+def thread_pool_executor(max_workers, mp_context, initializer, initargs):
+    """Thread-backed stand-in for ProcessPoolExecutor, so that the workers see the patched Llama"""
+    return ThreadPoolExecutor(max_workers, initializer=initializer, initargs=initargs)
+
+
+class TestDRESModel:
+    def setup_method(self):
+        self.sentences = ["a", "abc", "ab", "abcd", "abcde"]
+
+    def test_llama_wrapper_llama(self, monkeypatch):
+        monkeypatch.setattr(retrieval_module, "Llama", FakeLlama)
+        model = DRESModel(FakeLlama())
+
+        encoded = model.llama_wrapper(self.sentences, batch_size=2)
+
+        assert isinstance(encoded, torch.Tensor)
+        assert encoded.shape == (len(self.sentences), DIM)
+        assert torch.allclose(encoded.norm(dim=1), torch.ones(len(self.sentences)), atol=TOL)
+
+    def test_llama_wrapper_llama_pool(self, monkeypatch):
+        monkeypatch.setattr(retrieval_module, "Llama", FakeLlama)
+        monkeypatch.setattr(retrieval_module, "_worker_llama_model", None)
+        monkeypatch.setattr(retrieval_module, "ProcessPoolExecutor", thread_pool_executor)
+
+        with DRESModel(FakeLlama(pooling_type=2), num_processes=2, normalize_embeddings=False) as model:
+            assert model.model is None
+            encoded = model.llama_wrapper(self.sentences, batch_size=2)
+
+            worker_kwargs = retrieval_module._worker_llama_model.init_kwargs
+            assert worker_kwargs["pooling_type"] == 2
+            assert worker_kwargs["embedding"] is True
+        assert model._pool is None
+        assert encoded[:, 0].tolist() == pytest.approx([float(len(sentence)) for sentence in self.sentences])
+
+    def test_llama_pool_worker_failure_raises(self, monkeypatch):
+        monkeypatch.setattr(retrieval_module, "Llama", FakeLlama)
+        monkeypatch.setattr(retrieval_module, "_worker_llama_model", None)
+        monkeypatch.setattr(retrieval_module, "ProcessPoolExecutor", thread_pool_executor)
+
+        with DRESModel(FakeLlama(), num_processes=2) as model:
+            monkeypatch.setattr(retrieval_module, "Llama", FailingLlama)
+            with pytest.raises(BrokenExecutor):
+                model.llama_wrapper(self.sentences, batch_size=2)
+
+    def test_llama_overrides_keep_model_settings(self, monkeypatch):
+        monkeypatch.setattr(retrieval_module, "Llama", FakeLlama)
+
+        model = DRESModel(FakeLlama(n_gpu_layers=-1, pooling_type=2), n_threads=8)
+
+        assert model.model.init_kwargs["n_threads"] == 8
+        assert model.model.init_kwargs["n_threads_batch"] == 8
+        assert model.model.init_kwargs["n_gpu_layers"] == -1
+        assert model.model.init_kwargs["pooling_type"] == 2
+
+    def test_llama_worker_threads_capped_to_cores(self, monkeypatch):
+        monkeypatch.setattr(retrieval_module, "Llama", FakeLlama)
+        monkeypatch.setattr(retrieval_module, "_worker_llama_model", None)
+        monkeypatch.setattr(retrieval_module, "os", SimpleNamespace(sched_setaffinity=lambda pid, cores: None))
+        cores_queue = queue.Queue()
+        cores_queue.put([0, 1])
+
+        retrieval_module._init_llama_worker(
+            {"model_path": "model.gguf", "n_threads": 8, "n_threads_batch": 64}, cores_queue
+        )
+
+        assert retrieval_module._worker_llama_model.init_kwargs["n_threads_batch"] == 2
+        assert retrieval_module._worker_llama_model.init_kwargs["n_threads"] == 2
+
+    def test_llama_wrapper_encoder(self):
+        model = DRESModel(FakeEncoder())
+
+        encoded = model.llama_wrapper(self.sentences, batch_size=2)
+
+        assert encoded.shape == (len(self.sentences), DIM)
+
+    def test_encode_corpus_keeps_order(self, monkeypatch):
+        monkeypatch.setattr(retrieval_module, "Llama", FakeLlama)
+        model = DRESModel(FakeLlama(), normalize_embeddings=False)
+        corpus = [{"title": "", "text": sentence} for sentence in self.sentences]
+
+        encoded = model.encode_corpus(corpus, batch_size=2)
+
+        assert encoded[:, 0].tolist() == pytest.approx([float(len(sentence)) for sentence in self.sentences])
+
+    def test_encode_corpus_deduplicates(self, monkeypatch):
+        monkeypatch.setattr(retrieval_module, "Llama", FakeLlama)
+        llama = FakeLlama()
+        model = DRESModel(llama, normalize_embeddings=False)
+        corpus = {"text": self.sentences + self.sentences[::-1]}
+
+        encoded = model.encode_corpus(corpus, batch_size=2)
+
+        assert llama.num_embedded == len(self.sentences)
+        assert encoded[:, 0].tolist() == pytest.approx([float(len(sentence)) for sentence in corpus["text"]])
+
+    def test_encode_corpus_dataset(self, monkeypatch):
+        monkeypatch.setattr(retrieval_module, "Llama", FakeLlama)
+        model = DRESModel(FakeLlama(), normalize_embeddings=False)
+        corpus = datasets.Dataset.from_dict({"title": ["t"] * len(self.sentences), "text": self.sentences})
+
+        encoded = model.encode_corpus(corpus, batch_size=2)
+
+        assert encoded[:, 0].tolist() == pytest.approx([float(len(sentence)) + 2 for sentence in self.sentences])
+
+    def test_encode_corpus_sbert_deduplicates(self):
+        encoder = FakeSentenceTransformer()
+        model = DRESModel(encoder)
+        corpus = [{"text": sentence} for sentence in self.sentences + self.sentences[::-1]]
+
+        encoded = model.encode_corpus(corpus, batch_size=2)
+
+        assert model.use_sbert_model
+        assert sorted(encoder.encoded_sentences) == sorted(self.sentences)
+        assert encoded[:, 0].tolist() == pytest.approx([float(len(doc["text"])) for doc in corpus])
+
+    def test_encode_corpus_deduplicates_tail(self, monkeypatch):
+        monkeypatch.setattr(retrieval_module, "Llama", FakeLlama)
+        llama = FakeLlama()
+        model = DRESModel(llama, normalize_embeddings=False)
+        # Longest first, as beir passes the corpus, with the duplicates after the first 10000 sentences
+        corpus = {"text": [f"document number {i:05d}" for i in range(10000)] + ["short"] * 10000}
+
+        model.encode_corpus(corpus, batch_size=1000)
+
+        assert llama.num_embedded == 10001
+
+    def test_encode_corpus_empty(self):
+        encoder = FakeEncoder()
+        model = DRESModel(encoder)
+
+        encoded = model.encode_corpus([], batch_size=2)
+
+        assert len(encoded) == 0
+        assert encoder.encoded_sentences == []
+
+    def test_encode_corpus_deduplicates_list_output(self):
+        encoder = FakeEncoder()
+        model = DRESModel(encoder)
+        corpus = [{"text": sentence} for sentence in self.sentences + self.sentences[::-1]]
+
+        encoded = model.encode_corpus(corpus, batch_size=2, convert_to_numpy=False)
+
+        assert sorted(encoder.encoded_sentences) == sorted(self.sentences)
+        expected = [float(len(doc["text"])) for doc in corpus]
+        assert [embedding[0].item() for embedding in encoded] == pytest.approx(expected)